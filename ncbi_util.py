@@ -1,31 +1,139 @@
 import os
 import time
+import logging
+import asyncio
+import threading
+import weakref
+import random
+import sys
+import numbers
+from concurrent.futures import ThreadPoolExecutor
 import re
-import json
+import pickle
+import hashlib
+import sqlite3
+from io import BytesIO
+from functools import lru_cache
 from pathlib import Path
+from typing import Callable, Iterable
+# orjson parses the esearch responses straight from bytes, and a good deal
+# faster - but the standard library will do if it isn't installed
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
 import requests
-# because xml is dangerous
-from defusedxml import ElementTree as ET
-from xml.etree.ElementTree import Element
-import pandas as pd
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import aiohttp
+# lxml's parser is written in C, and can stream a document rather than
+# building the whole tree first (see NCBI.iter_taxa)
+from lxml import etree
+# (just for type hints - lxml's element class is private, but it's the type
+# of everything we get out of the parser)
+from lxml.etree import _Element as Element
 from collections import namedtuple, defaultdict
-from tqdm.notebook import tqdm
+from dataclasses import dataclass, asdict
 
 
+logger = logging.getLogger(__name__)
+
 BASE_URL = 'https://eutils.ncbi.nlm.nih.gov/entrez/eutils/'
+ESEARCH_URL = BASE_URL + 'esearch.fcgi'
+EFETCH_URL = BASE_URL + 'efetch.fcgi'
 
 EMAIL = os.environ['NCBI_EMAIL_ADDR']
 TOOL = os.environ['NCBI_TOOL_NAME']
-# The length of time we wait between making requests to the API.
-# The docs imply that you can make up to 3 requests per second without an API
-# key, but .5 is a bit safer (and more polite)
-SLEEP_INTERVAL = .5
+# unlike the email and tool name, an API key is optional
+API_KEY = os.environ.get('NCBI_API_KEY')
+# The number of requests per second we allow ourselves to make to the API.
+# The docs say you can make up to 3 requests per second without an API key,
+# and up to 10 with one.
+REQUESTS_PER_SECOND = 3
+REQUESTS_PER_SECOND_API_KEY = 10
+# The most (in seconds) we add at random to each wait for the rate limiter, so
+# that requests that were held up together don't all go out together
+RATE_LIMIT_JITTER = .05
 RETURN_RANKS = ['order', 'family', 'genus', 'species']
 JSON_PATH = 'data/IDA/json'
+# Where organisms we've already matched are stored between runs
+CACHE_PATH = 'data/IDA/ncbi_cache.db'
+# The most connections we keep open to the API at once (for both the requests
+# and the aiohttp sessions)
+MAX_CONNECTIONS = 10
+# Failed requests are retried after RETRY_BACKOFF_BASE * 2**attempt seconds,
+# but never more than RETRY_BACKOFF_MAX (unless the API's Retry-After header
+# asks for longer)
+RETRY_BACKOFF_BASE = 1
+RETRY_BACKOFF_MAX = 60
+# Client errors (bad parameters, etc.) won't go away by asking again - except
+# for "too many requests"
+RETRY_STATUSES = [429, 500, 502, 503, 504]
+# The number of names (or taxon ids) we send to the API in a single batched
+# request. The eutils docs suggest keeping it to around 200 per request.
+BATCH_SIZE = 200
+# The number of tasks running each stage of NCBI.run_pipeline
+PIPELINE_SEARCH_WORKERS = 3
+PIPELINE_FETCH_WORKERS = 1
+# The most taxon ids that can be waiting to be fetched in run_pipeline before
+# the searches have to wait for the fetches to catch up
+PIPELINE_QUEUE_SIZE = 256
+# The number of threads the async methods use to parse responses, so the
+# event loop can get on with other requests in the meantime
+PARSER_WORKERS = 4
+# The number of writes to the cache we let pile up before committing them
+CACHE_COMMIT_INTERVAL = 100
+
+# because xml is dangerous - this stops the parser from expanding entities or
+# fetching anything over the network (so no XXE or billion laughs)
+XML_PARSER_OPTIONS = {
+    'resolve_entities': False,
+    'no_network': True,
+    'huge_tree': False
+    }
+XML_PARSER = etree.XMLParser(**XML_PARSER_OPTIONS)
+
+# Used by default_preprocessor (and preprocess_names) to strip digits, and
+# then some extra bits on the end of the name
+DIGIT_RE = re.compile(r'\d')
+SUFFIX_RE = re.compile(r'_(?:sp|adult|larva)$')
+# keeps the first and last parts of an underscore separated name
+FIRST_LAST_RE = re.compile(r'^([^_]*)_(?:.*_)?([^_]*)$')
+# whitespace with something on either side of it - used by check_ncbi_param
+INTERNAL_SPACE_RE = re.compile(r'\S\s+\S')
+# the ways words can be joined in a name - used by normalize_name
+NAME_SEP_RE = re.compile(r'[+_ ]+')
+
+# The dtype of the taxon id columns in match_frame. Nullable (names that can't
+# be matched get <NA> rather than turning the column into floats), and NCBI
+# taxon ids are nowhere near big enough to need 64 bits.
+TAXON_ID_DTYPE = 'Int32'
 
 # TaxonInfo object
 TaxonInfo = namedtuple('TaxonInfo', ['rank', 'sci_name', 'taxon_id', 'lineage'])
 
+@dataclass(frozen=True, slots=True)
+class TaxonEntry:
+    """ One taxon in an organism's lineage (or the organism itself). With
+    slots there's no per-instance __dict__, which matters when there are
+    tens of thousands of these sitting in organisms_known.
+    """
+    rank: str
+    sci_name: str
+    taxon_id: int
+
+def taxon_info_to_dict(taxon_info: TaxonInfo):
+    """ Input:
+            taxon_info: TaxonInfo - see NCBI.etree_to_dict
+        Output:
+            dict - the same information as plain dicts and lists, i.e. for
+                json.dump (which would otherwise turn the TaxonInfo into a
+                list, and choke on the TaxonEntry objects).
+    """
+    return {
+        **taxon_info._asdict(),
+        'lineage': [asdict(entry) for entry in taxon_info.lineage]}
+
 def check_ncbi_param(ncbi_param: str, param_name: str):
     """ Input:
             ncbi_param: str - the value of a parameter we're going to pass to
@@ -39,11 +147,118 @@ def check_ncbi_param(ncbi_param: str, param_name: str):
     encoded by the requests library - so spaces become "+"), maybe I'll get rid
     of this later when I can test more.
     """
-    if (not isinstance(ncbi_param, str)) or (' ' in ncbi_param.strip()):
+    if (not isinstance(ncbi_param, str)
+            or INTERNAL_SPACE_RE.search(ncbi_param)):
             raise ValueError(f'"{param_name}" parameter must be a string \
                              containing no internal spaces')
     return ncbi_param
 
+def parse_idlist(content: bytes):
+    """ Input:
+            content: bytes - the body of a response from the esearch endpoint
+                (requested with retmode=json)
+        Output:
+            list - the idlist from the response (a list of strings). Empty if
+                NCBI couldn't make sense of the search.
+    """
+    result = json_loads(content).get('esearchresult', {})
+    if 'ERROR' in result:
+        logger.warning('esearch returned an error: %s', result['ERROR'])
+    return result.get('idlist', [])
+
+def parse_history(content: bytes):
+    """ Input:
+            content: bytes - the body of a response from the esearch endpoint
+                (requested with retmode=json and usehistory=y)
+        Output:
+            (webenv, query_key, count): the location of the results on the
+                NCBI history server, and the number of ids that were found.
+                (None, None, 0) if nothing was found.
+
+    When a search finds nothing - or NCBI couldn't make sense of it, in which
+    case there's an ERROR instead of results - there's no WebEnv/QueryKey in
+    the response. Either way the names just get looked up individually.
+    """
+    result = json_loads(content).get('esearchresult', {})
+    if 'ERROR' in result:
+        logger.warning('esearch returned an error: %s', result['ERROR'])
+        return None, None, 0
+    count = int(result.get('count', 0))
+    if not count:
+        return None, None, 0
+    return result['webenv'], result['querykey'], count
+
+def retry_delay(attempt: int, headers=None):
+    """ Input:
+            attempt: int - the number of attempts that have failed so far,
+                minus one
+            headers: Mapping - the headers of the failed response, if there
+                was one
+        Output:
+            float - the number of seconds to wait before trying again
+
+    Doubles the wait after each failure (up to RETRY_BACKOFF_MAX), unless the
+    API has told us how long to wait with a Retry-After header.
+    """
+    retry_after = headers.get('Retry-After') if headers else None
+    if retry_after is not None:
+        try:
+            return max(0, float(retry_after))
+        except ValueError:
+            # it's allowed to be an HTTP date instead - not worth parsing
+            pass
+    return min(RETRY_BACKOFF_BASE * 2**attempt, RETRY_BACKOFF_MAX)
+
+def ranks_tag(ranks):
+    """ Input:
+            ranks: Iterable[str] - the ranks kept in each lineage
+        Output:
+            str - a short tag that's the same for the same set of ranks (in
+                any order), for naming the cache tables.
+    """
+    return hashlib.sha1(','.join(sorted(ranks)).encode()).hexdigest()[:10]
+
+def batches(items: list, size: int = BATCH_SIZE):
+    """ Input:
+            items: list - the names (or ids) to send to the API
+            size: int - the most to send in one request
+        Output:
+            yields consecutive slices of items, each no longer than size
+    """
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+def progress_bar(iterable, **kwargs):
+    """ Input:
+            iterable - the thing we want to show progress for
+            kwargs - passed along to tqdm
+        Output:
+            the iterable wrapped in a tqdm progress bar (the notebook version if
+            we're in a notebook, the terminal one otherwise), or the iterable
+            itself if tqdm isn't installed.
+
+    tqdm is imported here rather than at the top of the module, so that
+    importing this module doesn't drag in the notebook machinery when nobody
+    asked for a progress bar.
+    """
+    try:
+        from tqdm.auto import tqdm
+    except ImportError:
+        return iterable
+    return tqdm(iterable, **kwargs)
+
+def normalize_name(name: str):
+    """ Input:
+            name: str - an organism name, either as given to the API (words
+                may be joined with "+" or "_") or as it comes back from it.
+        Output:
+            str - the name in lower case, with single spaces between words, so
+                that the names we send can be matched up with the scientific
+                names in a batched response.
+    """
+    return ' '.join(NAME_SEP_RE.split(name.strip())).lower()
+
+@lru_cache(maxsize=4096)
 def default_preprocessor(raw_name: str):
     """ Input:
             raw_name: str - the name of an organism. i.e. 'Asellus_aquaticus', 
@@ -69,26 +284,253 @@ def default_preprocessor(raw_name: str):
     than underscores ('+','-', ' ', etc.). Maybe camelcase too
     """
     # if there are numbers in the name, we remove them
-    raw_name = re.sub('[0-9]', '', raw_name)
+    raw_name = DIGIT_RE.sub('', raw_name)
     # gets rid of some extra bits on the end
     # NOTE: might want to add a "suffixes" argument or something to make this
     # configurable
-    raw_name = re.sub('_sp$|_adult$|_larva$', '', raw_name)
-    parts = raw_name.split('_')
-    if len(parts) > 1:
-        return '+'.join([parts[0], parts[-1]])
-    else:
-        return parts[0]
+    raw_name = SUFFIX_RE.sub('', raw_name)
+    if '_' not in raw_name:
+        return raw_name
+    return raw_name.partition('_')[0] + '+' + raw_name.rpartition('_')[2]
+
+def preprocess_names(names):
+    """ Input:
+            names: list or pd.Series - organism names
+        Output:
+            pd.Series - the names after going through the same steps as
+                default_preprocessor.
+
+    This does the work with pandas' string methods, one step at a time across
+    the whole column, rather than calling default_preprocessor in a Python
+    loop - useful when you've got a very large list of names.
+    """
+    # pandas is slow to import, and only the frame-building functions need it
+    import pandas as pd
+    names = pd.Series(names, dtype=object)
+    return (names
+            .str.replace(DIGIT_RE, '', regex=True)
+            .str.replace(SUFFIX_RE, '', regex=True)
+            .str.replace(FIRST_LAST_RE, r'\1+\2', regex=True))
+
+class TokenBucket:
+    """ A token bucket rate limiter. The bucket holds up to "capacity"
+    tokens and refills at "rate" tokens per second; each request takes one
+    token, and only has to wait if the bucket is empty. So a few requests can
+    go out straight away, and after that they're spaced out just enough to
+    stay under the rate - rather than always sleeping a fixed amount.
+
+    The same bucket can be shared by the sync methods (wait), several
+    threads, and the async methods (acquire).
+    """
+    def __init__(
+            self,
+            rate: float,
+            capacity: float = None):
+        """ Input:
+                rate: float - the number of tokens added per second
+                capacity: float - the most tokens the bucket can hold (i.e. the
+                    biggest burst of requests). Defaults to rate.
+        """
+        self.rate = rate
+        self.capacity = rate if capacity is None else capacity
+        self.tokens = self.capacity
+        self.last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _take(self):
+        """ Output:
+                float - 0 if we got a token, otherwise the number of seconds
+                    until there will be one.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.capacity,
+                self.tokens + (now - self.last_refill) * self.rate)
+            self.last_refill = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def wait(self):
+        """ Blocks until a token is available, and takes it.
+        """
+        while (delay := self._take()):
+            time.sleep(delay + random.uniform(0, RATE_LIMIT_JITTER))
+
+    async def acquire(self):
+        """ The async version of wait.
+        """
+        while (delay := self._take()):
+            await asyncio.sleep(delay + random.uniform(0, RATE_LIMIT_JITTER))
+
+    def drain(self, seconds: float = 0):
+        """ Input:
+                seconds: float - how long nobody should get a token for
+
+        Empties the bucket (and then some), for when the API tells us we're
+        going too fast. Every request sharing the bucket backs off, not just
+        the one that got the 429.
+        """
+        with self._lock:
+            self.tokens = min(self.tokens, -seconds * self.rate)
+            self.last_refill = time.monotonic()
+
+class RateLimitedRetry(Retry):
+    """ urllib3's Retry, but waiting between attempts the same way the
+    async methods do (see retry_delay), and going through a TokenBucket - so
+    retries count against the rate cap like any other request, and a 429
+    makes every thread sharing the bucket back off, not just this one.
+    """
+    def __init__(self, *args, rate_limiter: TokenBucket = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.rate_limiter = rate_limiter
+
+    def new(self, **kwargs):
+        # urllib3 makes a new Retry after every attempt
+        retry = super().new(**kwargs)
+        retry.rate_limiter = self.rate_limiter
+        return retry
+
+    def sleep(self, response=None):
+        headers = response.headers if response is not None else None
+        delay = retry_delay(max(len(self.history) - 1, 0), headers)
+        last = self.history[-1] if self.history else None
+        # (the error's type rather than the error, which can include the url)
+        logger.warning(
+            'request failed (%s). Waiting %s seconds and trying again...',
+            last and (last.status or type(last.error).__name__), delay)
+        if response is not None and response.status == 429:
+            # wait() below will do the waiting for us (and for everyone else)
+            self.rate_limiter.drain(delay)
+        else:
+            time.sleep(delay)
+        self.rate_limiter.wait()
+
+class PersistentCache:
+    """ A small dict-like store backed by a SQLite table, so that the things
+    we retrieve from the NCBI API survive between runs. Values are pickled
+    (TaxonInfo is a namedtuple, so it pickles fine).
+
+    New entries are held in memory and written out together every
+    CACHE_COMMIT_INTERVAL sets (and on commit/close), so that we aren't paying
+    for a disk sync after every single organism. Each write-out is one short
+    transaction - SQLite only lets one connection write at a time, so an open
+    transaction would lock out every other NCBI instance (another notebook,
+    another script) using the same file until it was committed.
+    """
+    def __init__(
+            self,
+            path: str,
+            table: str = 'organisms',
+            key_type: str = 'TEXT',
+            conn: sqlite3.Connection = None):
+        """ Input:
+                path: str - the location of the SQLite database. Parent
+                    directories are created if they don't exist.
+                table: str - the name of the table to keep the entries in
+                key_type: str - the SQLite type of the keys
+                conn: sqlite3.Connection - a connection (to the same database)
+                    to share with another PersistentCache, rather than opening
+                    a new one.
+        """
+        if conn is None:
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+            # The NCBI class guards access with a lock, so the connection can
+            # be shared with match_many_threaded's worker threads.
+            # isolation_level=None stops the sqlite3 module from quietly
+            # opening a transaction (and holding the lock) on the first write
+            # - commit() opens and closes its own.
+            conn = sqlite3.connect(
+                path,
+                check_same_thread=False,
+                isolation_level=None)
+        self.conn = conn
+        self.table = table
+        self.conn.execute(
+            f'CREATE TABLE IF NOT EXISTS {table} '
+            f'(key {key_type} PRIMARY KEY, value BLOB)')
+        # key -> pickled value, for the entries that haven't been written yet
+        self._pending = dict()
+
+    def get(self, key, default=None):
+        if key in self._pending:
+            return pickle.loads(self._pending[key])
+        row = self.conn.execute(
+            f'SELECT value FROM {self.table} WHERE key = ?',
+            (key,)).fetchone()
+        if row is None:
+            return default
+        return pickle.loads(row[0])
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __setitem__(self, key, value):
+        self._pending[key] = pickle.dumps(value)
+        if len(self._pending) >= CACHE_COMMIT_INTERVAL:
+            self.commit()
+
+    def clear(self):
+        self._pending.clear()
+        self.conn.execute(f'DELETE FROM {self.table}')
+
+    def __len__(self):
+        self.commit()
+        return self.conn.execute(
+            f'SELECT COUNT(*) FROM {self.table}').fetchone()[0]
+
+    def commit(self):
+        """ Writes the pending entries out in a single transaction.
+        """
+        if not self._pending:
+            return
+        self.conn.execute('BEGIN')
+        try:
+            self.conn.executemany(
+                f'INSERT OR REPLACE INTO {self.table} (key, value) '
+                'VALUES (?, ?)',
+                self._pending.items())
+        except BaseException:
+            self.conn.execute('ROLLBACK')
+            raise
+        self.conn.execute('COMMIT')
+        self._pending.clear()
+
+    def close(self):
+        self.commit()
+        self.conn.close()
+
+def close_caches(*caches: PersistentCache):
+    """ Input:
+            caches: PersistentCache - caches that share a connection
+
+    Writes out whatever each of the caches still has pending, then closes
+    their (shared) connection.
+    """
+    for cache in caches:
+        cache.commit()
+    caches[0].conn.close()
 
 class NCBI:
     def __init__(
             self,
             email: str = EMAIL,
             tool: str = TOOL,
-            preprocessor: func = None,
+            preprocessor: Callable = None,
             return_ranks: list = None,
             max_attempts: int = 3,
-            timeout: int = 10
+            timeout: int = 10,
+            cache_path: str = CACHE_PATH,
+            api_key: str = API_KEY,
+            cache_failures: bool = False
             ):
         """ Input:
                 email: str - the email address that will be used when making the
@@ -96,14 +538,26 @@ class NCBI:
                     internal spaces.
                 tool: str - the name of application making the E-utility call.
                     Value must be a string with no internal spaces.
-                preprocessor: func - a function to pre-process the organism
+                preprocessor: Callable - a function to pre-process the organism
                     names being fed to this. If None, the default preprocessor
                     is used instead
-                return_ranks: list - the ranks that will be kept and returned
+                return_ranks: list - the ranks that will be kept and returned.
+                    If None, RETURN_RANKS is used.
                 max_attempts: int - the number of retries to make  to the API
                     before giving up
                 timeout: int - the length of time in seconds to wait before 
                     assuming something went wrong with the request
+                cache_path: str - where to keep the organisms we've matched, so
+                    later runs don't have to ask the API for them again. If
+                    None, nothing is kept between runs. Instances with
+                    different return_ranks keep their taxa in separate tables.
+                api_key: str - an NCBI API key. Optional (defaults to the
+                    NCBI_API_KEY environment variable), but with one we're
+                    allowed to make more requests per second.
+                cache_failures: bool - if True, the searches for names that
+                    matched nothing (or several taxa) are kept in the cache
+                    too, so they aren't searched for again on later runs. See
+                    clear_failures for when you've fixed some of them.
 
         Information on parameters, syntax, etc. for the API (including the
         "tool" and "email" parameters for this class) can be found here:
@@ -112,48 +566,199 @@ class NCBI:
         """
         self.email = check_ncbi_param(email, 'email')
         self.tool = check_ncbi_param(tool, 'tool')
-        self.return_ranks = return_ranks
-        self.disambiguate = []
-        self.no_match = []
+        self.return_ranks = return_ranks or RETURN_RANKS
+        # for quick membership checks while parsing lineages
+        self._ranks_set = frozenset(self.return_ranks)
+        # the position of each rank's columns in match_frame
+        self._rank_index = {r: i for i, r in enumerate(self.return_ranks)}
+        # names (after preprocessing) that matched several taxa, or none - sets,
+        # since we check them before every lookup
+        self.disambiguate = set()
+        self.no_match = set()
         self.organisms_known = dict()
-        if not preprocessor:
-            self.preprocessor = default_preprocessor
+        # Different names (synonyms, misspellings NCBI corrects for us) can
+        # lead to the same taxon id, so the parsed taxa are also kept by id
+        self.taxa_known = dict()
+        if cache_path:
+            # The lineages are filtered down to return_ranks as they're
+            # parsed, so a taxon cached with one set of ranks is no good to an
+            # instance that wants another - each set gets its own tables
+            tag = ranks_tag(self._ranks_set)
+            self.cache = PersistentCache(cache_path, table=f'organisms_{tag}')
+            self.taxid_cache = PersistentCache(
+                cache_path,
+                table=f'taxa_{tag}',
+                key_type='INTEGER',
+                conn=self.cache.conn)
+            # the raw esearch results. Names that couldn't be matched are only
+            # kept if cache_failures is set (see remember_search)
+            self.search_cache = PersistentCache(
+                cache_path,
+                table='searches',
+                conn=self.cache.conn)
+            # If close() is never called (i.e. ncbi = NCBI(); ncbi.match(...)
+            # in a notebook), the last few writes would otherwise be lost
+            # when the object is garbage collected - this writes them out
+            # then, or when the interpreter exits, whichever comes first
+            self._close_cache = weakref.finalize(
+                self,
+                close_caches,
+                self.cache,
+                self.taxid_cache,
+                self.search_cache)
+        else:
+            self.cache = None
+            self.taxid_cache = None
+            self.search_cache = None
+        self.api_key = api_key
+        self.cache_failures = cache_failures
+        # the same for every request, so there's no need to rebuild it each
+        # time
+        self._base_payload = self.base_payload()
+        self.max_attempts = max_attempts
+        self.timeout = timeout
+        # Rather than sleeping after every request, every request (sync,
+        # threaded or async) takes a token from the same bucket, and only
+        # waits if it's empty.
+        if api_key:
+            self.requests_per_second = REQUESTS_PER_SECOND_API_KEY
+        else:
+            self.requests_per_second = REQUESTS_PER_SECOND
+        # No bursts: a full bucket goes out at once *and* keeps refilling, so
+        # anything bigger than 1 would let capacity + rate requests through
+        # in the first second - over the NCBI cap, and straight into 429s
+        self.rate_limiter = TokenBucket(self.requests_per_second, capacity=1)
+        # match_many_threaded works from several threads: this guards
+        # organisms_known, no_match, disambiguate and the cache
+        self._state_lock = threading.RLock()
+        # Every request goes to the same host, so we keep one session around
+        # and reuse its connections rather than doing a new TCP/TLS handshake
+        # each time. Retries are handled by urllib3 (see RateLimitedRetry).
+        self.session = requests.Session()
+        # The XML that efetch returns is very repetitive, so it compresses
+        # well (requests would ask for gzip anyway, but let's be explicit)
+        self.session.headers['Accept-Encoding'] = 'gzip'
+        retry = RateLimitedRetry(
+            total=max_attempts,
+            status_forcelist=RETRY_STATUSES,
+            rate_limiter=self.rate_limiter,
+            # we only POST to send long lists of names/ids - it's just as safe
+            # to repeat as a GET
+            allowed_methods=['GET', 'POST'])
+        self.session.mount(
+            'https://',
+            HTTPAdapter(
+                pool_connections=1,
+                pool_maxsize=MAX_CONNECTIONS,
+                max_retries=retry))
+        # These are only set up when the class is used as an async context
+        # manager (see __aenter__)
+        self._session = None
+        self._parser_pool = None
+        self.preprocessor = preprocessor or default_preprocessor
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """ Closes the requests session (and its pooled connections), and
+        commits anything that's still waiting to be written to the cache.
+        """
+        self.session.close()
+        if self.cache is not None:
+            with self._state_lock:
+                # (this only ever runs once)
+                self._close_cache()
+
+    def commit(self):
+        """ Writes anything that's waiting in the cache to disk, without
+        closing anything. The batch methods (match_many, etc.) call this when
+        they're done, so that their results are kept even if close() never
+        gets called.
+        """
+        if self.cache is not None:
+            with self._state_lock:
+                for cache in (self.cache, self.taxid_cache, self.search_cache):
+                    cache.commit()
+
+    async def __aenter__(self):
+        """ Opens the aiohttp session (and the parser threads) used by the
+        async methods. i.e.:
+                async with NCBI() as ncbi:
+                    results = await ncbi.match_many(names)
+        """
+        self._session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=MAX_CONNECTIONS),
+            timeout=aiohttp.ClientTimeout(total=self.timeout))
+        # Parsing is CPU work that would hold up the event loop - the async
+        # methods hand it off to these threads (lxml lets go of the GIL while
+        # it parses)
+        self._parser_pool = ThreadPoolExecutor(max_workers=PARSER_WORKERS)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self._session.close()
+        self._session = None
+        self._parser_pool.shutdown()
+        self._parser_pool = None
+        self.commit()
 
     def make_req(
             self,
             url: str,
             payload: dict,
+            stream: bool = False,
+            method: str = 'GET'
             ):
         """ Input:
                 url: str - the url we want to make the request to
                 payload: dict - contains the values we want to pass as parameters
-                    in the URL's query string
+                    in the URL's query string (or in the body, for a POST)
+                stream: bool - if True, the body isn't downloaded up front; it
+                    can be read (already decompressed) from req.raw instead.
+                    The caller should close the response when it's done.
+                method: str - 'GET' or 'POST'. The API wants a POST when we're
+                    sending a long list of names or ids.
                 
             Output:
                 req: requests.Response - the response returned by the NCBI API
 
-        This attempts a GET request, and then waits for a bit and tries again if
-        it receives a RequestException. It helps if you've got some transient
-        network issues between you and the other fella.
+        This makes a request using the session set up in __init__, which
+        retries (backing off a little longer each time) on connection errors
+        and on the status codes NCBI uses when it's overloaded or rate
+        limiting us. It helps if you've got some transient network issues
+        between you and the other fella.
         Also: having all the requests go through this method makes it easier
         to keep track of stuff like the slight delay between requests (to avoid
-        being rate limited)
+        being rate limited). We only wait if rate_limiter says we've been
+        making requests too quickly.
         """
-        for i in range(max_attempts + 1):
-            try:
-                req = requests.get(
-                    url,
-                    params=payload,
-                    timeout=timeout)
-                req.raise_for_status()
-                time.sleep(SLEEP_INTERVAL)
-                return req
-            except requests.RequestException as e:
-                if i == max_attempts:
-                    raise e
-                print('connection issue. Waiting 1 second and trying again...')
-                time.sleep(1)
-        raise requests.HTTPError
+        if method == 'POST':
+            kwargs = {'data': payload}
+        else:
+            kwargs = {'params': payload}
+        self.rate_limiter.wait()
+        req = self.session.request(
+            method,
+            url,
+            stream=stream,
+            timeout=self.timeout,
+            **kwargs)
+        try:
+            req.raise_for_status()
+        except requests.HTTPError:
+            # a streamed response hasn't been read, so it would hang on to its
+            # connection (rather than going back to the pool) until it's
+            # garbage collected
+            req.close()
+            raise
+        if stream:
+            # have urllib3 undo the gzip encoding as we read from req.raw
+            req.raw.decode_content = True
+        return req
 
     def esearch_req(
             self,
@@ -169,40 +774,162 @@ class NCBI:
         Docs are here:
         https://www.ncbi.nlm.nih.gov/books/NBK25499/#chapter4.ESearch
         """
-        url = BASE_URL + 'esearch.fcgi'
+        req = self.make_req(ESEARCH_URL, self.esearch_payload(organism))
+        return req
+
+    def base_payload(self):
+        """ Output:
+                payload: dict - the query string parameters that go along with
+                    every request we make to the API (identifying us, and our
+                    API key if we have one).
+        """
         payload = {
-            'mail': self.email,
-            'tool': self.tool,
+            'email': self.email,
+            'tool': self.tool}
+        if self.api_key:
+            payload['api_key'] = self.api_key
+        return payload
+
+    def esearch_payload(
+            self,
+            organism: str):
+        """ Input:
+                organism: str - the name of the organism whose ID we want.
+            Output:
+                payload: dict - the query string parameters for an esearch
+                    request for the organism in question.
+        """
+        payload = self._base_payload | {
             'db':'taxonomy',
             'term':organism,
             'rettype':'uilist',
             'retmode':'json'
             }
-        req = self.make_req(url, payload)
-        return req
+        return payload
 
     def efetch_req(
             self,
-            taxid: int):
+            taxid: int | str | Iterable[int],
+            stream: bool = False):
         """ Input:
-                taxid: int - the taxon ID that we want more information on
+                taxid: int, str or Iterable[int] - the taxon ID (or IDs) that
+                    we want more information on
+                stream: bool - passed along to make_req
             Output:
                 req: requests.Response - the response returned by the efetch
-                    endpoint of the NCBI API for the taxon in question.
+                    endpoint of the NCBI API for the taxon (or taxa) in
+                    question.
 
         The NCBI eutils efetch endpoint returns data records for a UID or list of
         UIDs.
         Docs are here:
         https://www.ncbi.nlm.nih.gov/books/NBK25499/#chapter4.EFetch
         """
-        url = BASE_URL + 'efetch.fcgi'
-        payload = {
-            'mail': self.email,
-            'tool': self.tool,
+        # a single id can come as a string (as in an esearch idlist) or any
+        # kind of integer (numpy's included)
+        if isinstance(taxid, (str, numbers.Integral)):
+            req = self.make_req(
+                EFETCH_URL, self.efetch_payload(taxid), stream=stream)
+        else:
+            # a list of ids can get long, so it goes in the body of a POST
+            payload = self.efetch_payload(','.join(map(str, taxid)))
+            req = self.make_req(
+                EFETCH_URL, payload, stream=stream, method='POST')
+        return req
+
+    def taxids_to_infos(
+            self,
+            taxids: Iterable[int]):
+        """ Input:
+                taxids: Iterable[int] - the taxon IDs that we want more
+                    information on
+            Output:
+                list - a TaxonInfo for each of the taxa
+
+        Retrieves all of the taxa with a single efetch request.
+        """
+        with self.efetch_req(taxids, stream=True) as req:
+            return list(self.iter_taxa(req.raw))
+
+    def names_to_infos(
+            self,
+            names: list):
+        """ Input:
+                names: list - the names of the organisms we want to search for
+                    (no more than BATCH_SIZE of them)
+            Output:
+                list - a TaxonInfo for each taxon that matched any of the names
+
+        POSTs all of the names to esearch in one request, leaving the results
+        on the NCBI history server, then retrieves them all with one efetch -
+        so the ids never have to be sent back. See resolve_batch for working
+        out which taxon goes with which name.
+        """
+        req = self.make_req(
+            ESEARCH_URL,
+            self.esearch_history_payload(names),
+            method='POST')
+        webenv, query_key, count = parse_history(req.content)
+        if not count:
+            return []
+        with self.make_req(
+                EFETCH_URL,
+                self.efetch_history_payload(webenv, query_key, count),
+                stream=True,
+                method='POST') as req:
+            return list(self.iter_taxa(req.raw))
+
+    def esearch_history_payload(
+            self,
+            names: list):
+        """ Input:
+                names: list - the names of the organisms we want to search for
+            Output:
+                payload: dict - the parameters for a single esearch request for
+                    all of the names (as "name1 OR name2 OR ..."), with the
+                    results kept on the history server.
+        """
+        payload = self.esearch_payload(
+            ' OR '.join(f'({name})' for name in names))
+        payload['usehistory'] = 'y'
+        # the ids stay on the history server, so there's no point having them
+        # sent back (and parsed) as well - the count is all we need
+        payload['retmax'] = 0
+        return payload
+
+    def efetch_history_payload(
+            self,
+            webenv: str,
+            query_key: str,
+            count: int):
+        """ Input:
+                webenv, query_key: str - the location of some search results
+                    on the history server (see parse_history)
+                count: int - the number of taxa to retrieve
+            Output:
+                payload: dict - the parameters for an efetch request for the
+                    taxa in those results.
+        """
+        payload = self._base_payload | {
+            'db':'taxonomy',
+            'WebEnv':webenv,
+            'query_key':query_key,
+            'retmax':count}
+        return payload
+
+    def efetch_payload(
+            self,
+            taxid: int):
+        """ Input:
+                taxid: int - the taxon ID that we want more information on
+            Output:
+                payload: dict - the query string parameters for an efetch
+                    request for the taxon in question.
+        """
+        payload = self._base_payload | {
             'db':'taxonomy',
             'id':taxid}
-        req = self.make_req(url, payload)
-        return req
+        return payload
 
     def organism_to_id(
             self,
@@ -220,8 +947,11 @@ class NCBI:
         """
         if verbose:
             print('Starting organism:', organism)
-        req = self.esearch_req(organism)
-        id_list = req.json()['esearchresult']['idlist']
+        id_list = self.lookup_search(organism)
+        if id_list is None:
+            req = self.esearch_req(organism)
+            id_list = parse_idlist(req.content)
+            self.remember_search(organism, id_list)
         return id_list
 
     def etree_from_id(
@@ -230,69 +960,133 @@ class NCBI:
         """ Input:
                 taxid: int - an NCBI taxonomic id.
             Output:
-                tree: defusedxml.ElementTree - an element tree containing the
+                tree: lxml.etree._Element - an element tree containing the
                     lineage information returned by the NCBI efetch API for the
                     organism with the given taxid.
         """
-        req = self.efetch_req(taxid)
-        tree = ET.fromstring(req.content)
+        # parsed as it comes off the wire, rather than reading the whole
+        # response into memory first
+        with self.efetch_req(taxid, stream=True) as req:
+            tree = etree.parse(req.raw, XML_PARSER).getroot()
         return tree
 
     def etree_to_dict(self,
-                      root: ET):
+                      root: Element):
         """ Input:
-                root: defusedxml.ElementTree - an xml document as returned by 
+                root: lxml.etree._Element - an xml document as returned by 
                     the NCBI API efetch endpoint.
             Output:
                 taxon_info: TaxonInfo namedtuple - the keys are:
                     - rank: the rank of the organism, i.e. order, phylum, etc.
                     - sci_name: the scientific name of the organism
                     - taxon_id: the taxonomic id (an int)
-                    - lineage: a list of dicts. The keys are:
-                        - rank:
-                        - sci_name: 
-                        - taxon_id: 
-        Note: Within taxon_info we have the lineage dictionary, which is a list
-        of dicts. We're using a list of dicts because some ranks (specifically
-        "clade") can appear multiple times.
-        I decided to preserve all of the lineage data at this stage and filter
-        out unused entries further down the line, so it will be easy to rework -
-        just in case I find a use for the extra data somewhere.
+                    - lineage: a tuple of TaxonEntry objects (each with a rank,
+                        sci_name and taxon_id), from the top of the tree down.
+        Note: the lineage is a flat sequence rather than a dict keyed on rank
+        because some ranks (specifically "clade") can appear multiple times.
+        Only the ranks in return_ranks are kept - thousands of these can end
+        up in organisms_known, and most of a lineage is ranks we never look at.
+        """
+        return self.taxon_to_info(root.find('Taxon'))
+
+    def iter_taxa(self,
+                  source):
+        """ Input:
+                source: a file-like object containing an xml document as
+                    returned by the NCBI API efetch endpoint (for one or
+                    several taxa)
+            Output:
+                yields a TaxonInfo for each taxon in the document
+
+        Rather than building the whole tree and then searching through it, this
+        streams the document and hands back each taxon as soon as its closing
+        tag has been parsed. Taxa we're done with are cleared out of the tree,
+        so memory use stays at roughly one taxon no matter how many there are
+        in the response.
+        """
+        for _, taxon in etree.iterparse(
+                source,
+                events=('end',),
+                tag='Taxon',
+                **XML_PARSER_OPTIONS):
+            # the taxa inside LineageEx are handled along with their organism
+            if taxon.getparent().tag == 'LineageEx':
+                continue
+            yield self.taxon_to_info(taxon)
+            taxon.clear()
+            while taxon.getprevious() is not None:
+                del taxon.getparent()[0]
+
+    def taxon_to_info(self,
+                      root_taxon: Element):
+        """ Input:
+                root_taxon: Element - a top level 'Taxon' element from an efetch
+                    response (i.e. one that contains a LineageEx)
+            Output:
+                taxon_info: TaxonInfo namedtuple - see etree_to_dict
         """
         # This gets us the rank, scientific name, and taxon id for the organism
-        root_taxon = root.find('Taxon')
-        rank, taxon_info = self.parse_taxon_element(root_taxon)
-        taxon_info['rank'] = rank
+        organism = self.parse_taxon_element(root_taxon)
         
-        # This gets a list of the taxa in the organism's lineage and then 
-        # creates a dictionary of lists, in which each entry is a dict 
-        # containing scientific name and taxonomic id
-        lineage = defaultdict(list)
-        taxa = root_taxon.find('LineageEx').findall('Taxon')
-        for taxon in taxa:
-            rank, info = self.parse_taxon_element(taxon)
-            lineage[rank].append(info)
-            
-        taxon_info['lineage'] = lineage
-        return TaxonInfo(**taxon_info)
+        # This gets the taxa in the organism's lineage, skipping the ranks we
+        # don't want
+        # (local names for the things we use on every pass, so Python doesn't
+        # have to look them up on self/lineage each time)
+        ranks = self._ranks_set
+        parse = self.parse_taxon_element
+        lineage = []
+        append = lineage.append
+        for taxon in root_taxon.find('LineageEx').iterchildren('Taxon'):
+            entry = parse(taxon, ranks)
+            if entry is not None:
+                append(entry)
+
+        return TaxonInfo(
+            rank=organism.rank,
+            sci_name=organism.sci_name,
+            taxon_id=organism.taxon_id,
+            lineage=tuple(lineage))
 
     def parse_taxon_element(
             self,
-            taxon: Element):
+            taxon: Element,
+            ranks: frozenset = None):
         ''' Input:
                 taxon: Element - the 'Taxon' element from the element tree which
                     we retrieved from the NCBI API
+                ranks: frozenset - if given, taxa with any other rank are
+                    skipped
             Output:
-                (rank, info): a tuple. "rank" is the rank of the element (i.e.
-                    "order", "phylum", etc.), and "info" is a dictionary
-                    containing the scientific name and taxon id for that rank.
+                TaxonEntry - the rank of the element (i.e. "order", "phylum",
+                    etc.), and its scientific name and taxon id. None if its
+                    rank isn't in ranks.
         '''
-        rank = taxon.find('Rank').text
-        info = {
-            'sci_name': taxon.find('ScientificName').text,
-            'taxon_id': int(taxon.find('TaxId').text)
-        }
-        return rank, info
+        # One pass over the children, dispatching on the tag, rather than a
+        # find() for each field. The three fields come before the bulky ones
+        # (LineageEx, etc.) in an efetch response, so we stop as soon as we've
+        # seen all of them.
+        rank = sci_name = taxon_id = None
+        for child in taxon.iterchildren():
+            tag = child.tag
+            if tag == 'Rank':
+                rank = child.text
+                # most of a lineage is ranks we don't want, so we bail out of
+                # those before doing any more work on them
+                if ranks is not None and rank not in ranks:
+                    return None
+            elif tag == 'ScientificName':
+                sci_name = child.text
+            elif tag == 'TaxId':
+                taxon_id = child.text
+            else:
+                continue
+            if (rank is not None
+                    and sci_name is not None
+                    and taxon_id is not None):
+                break
+        # there are only a couple dozen distinct ranks, so every entry can
+        # share the same handful of strings
+        return TaxonEntry(sys.intern(rank), sci_name, int(taxon_id))
 
     def organism_to_dict(
             self,
@@ -306,29 +1100,82 @@ class NCBI:
                 tax_dict: dict - a dictionary containing the taxonomy data about
                     "organism" which was returned by the NCBI API
         '''
-        taxid_list = self.organism_to_id(organism, verbose)
+        taxid_list = self.organism_to_id(organism, verbose=verbose)
+        taxid = self.single_taxid(organism, taxid_list)
+        if not taxid:
+            return False
+        tax_dict = self.lookup_taxid(taxid)
+        if tax_dict is None:
+            tax_dict = self.taxid_to_info(taxid)
+            self.remember_taxid(taxid, tax_dict)
+        return tax_dict
+
+    def taxid_to_info(
+            self,
+            taxid: int):
+        ''' Input:
+                taxid: int - an NCBI taxonomic id.
+            Output:
+                taxon_info: TaxonInfo - see etree_to_dict
+
+        This does the same job as etree_to_dict(etree_from_id(taxid)), but the
+        response is parsed as it comes off the wire rather than being read
+        into memory (and then into a tree) first.
+        '''
+        with self.efetch_req(taxid, stream=True) as req:
+            return self.single_taxon(req.raw, taxid)
+
+    def single_taxon(
+            self,
+            source,
+            taxid: int):
+        ''' Input:
+                source: a file-like object containing the efetch response for
+                    a single taxon
+                taxid: int - the taxon id we asked for (for the error message)
+            Output:
+                taxon_info: TaxonInfo - see etree_to_dict
+        '''
+        # reading the response to the end (rather than stopping at the first
+        # taxon) lets a streamed connection go back to the session's pool
+        taxa = list(self.iter_taxa(source))
+        if not taxa:
+            raise ValueError(f'efetch returned no taxon for taxid {taxid}')
+        return taxa[0]
 
+    def single_taxid(
+            self,
+            organism: str,
+            taxid_list: list):
+        ''' Input:
+                organism: str - the organism we searched for
+                taxid_list: list - the idlist returned by the esearch endpoint
+                    for that organism
+            Output:
+                taxid: int - the organism's taxon id, or False if the list
+                    doesn't contain exactly one id.
+        '''
         # If more than 1 taxon id is returned that means we can't match the name
         # given to a single organism. 
         # The user will need to disambiguate the name
         if len(taxid_list) > 1:
-            self.disambiguate.append(organism)
+            with self._state_lock:
+                self.disambiguate.add(organism)
             return False
 
         # If no taxon ids were returned, that means we weren't able to find a
         # match. The user will have to check the spelling of the name.
         if not taxid_list:
-            self.no_match.append(organism)
+            with self._state_lock:
+                self.no_match.add(organism)
             return False
         
-        if not taxid_list[0].isdigit():
+        try:
+            return int(taxid_list[0])
+        except ValueError:
             raise ValueError(f'Expected API to return one taxon id consisting \
-                            of all decimal characters. Returned {id_list[0]} \
-                            instead.')
-        taxid = int(taxid_list[0])
-        tree = self.etree_from_id(taxid)
-        tax_dict = self.etree_to_dict(tree)
-        return tax_dict
+                            of all decimal characters. Returned \
+                            {taxid_list[0]} instead.') from None
 
     def match(
         self,
@@ -346,16 +1193,784 @@ class NCBI:
                         - taxonomic ID
                         - lineage 
                     If a match cannot be made, False is returned instead.
+
+        The name is run through the preprocessor first, and everything we
+        know about it is keyed on the result - so e.g. "Asellus_aquaticus_adult"
+        and "Asellus_aquaticus_larva" only get looked up once.
         """
+        return self._match_preprocessed(self.preprocessor(org_name), verbose)
+
+    def _match_preprocessed(
+        self,
+        org_name: str,
+        verbose: bool = False):
         # skips the call to the API if the data for the organism has already
-        # been retrieved
-        if org_name in self.organisms_known:
-            return self.organisms_known[org_name]
+        # been retrieved (in this run or an earlier one), or if we already know
+        # it can't be matched
+        taxon_info = self.lookup_known(org_name)
+        if taxon_info is not None:
+            return taxon_info
+
+        taxon_info = self.organism_to_dict(org_name, verbose)
+        self.remember(org_name, taxon_info)
+        return taxon_info
+
+    def _pending_names(
+        self,
+        names: list):
+        """ Input:
+                names: list - the names of the organisms we want to match
+            Output:
+                canonical: dict - maps each name to its preprocessed version
+                pending: list - the distinct preprocessed names we don't know
+                    anything about yet, i.e. the ones to send to the API
+
+        The shared first step of the methods that match a whole list of names.
+        Each name only goes to the API once, however many times it (or a name
+        that preprocesses to the same thing) shows up - duplicates would also
+        race each other past the organisms_known check.
+        """
+        canonical = {name: self.preprocessor(name) for name in names}
+        pending = [org_name for org_name in dict.fromkeys(canonical.values())
+                   if self.lookup_known(org_name) is None]
+        return canonical, pending
+
+    def _results(
+        self,
+        canonical: dict):
+        """ Input:
+                canonical: dict - as returned by _pending_names
+            Output:
+                dict - maps each of the original names to its TaxonInfo (or
+                    False, if a match couldn't be made)
+        """
+        return {name: self.lookup_known(org_name)
+                for name, org_name in canonical.items()}
+
+    def match_many_threaded(
+        self,
+        names: list,
+        workers: int = 3,
+        verbose: bool = False):
+        """ Input:
+                names: list - the names of the organisms we want to match
+                workers: int - the number of threads making requests (at
+                    most MAX_CONNECTIONS)
+                verbose: bool - if True, some information will be printed as
+                    the data is retrieved.
+            Output:
+                dict - maps each name to its TaxonInfo (or False, if a match
+                    couldn't be made)
+
+        A version of match_many that doesn't need an event loop. Names are
+        first looked up in batches (see names_to_infos and resolve_batch).
+        Whatever's left is searched for individually, spread over a pool of
+        threads, and then the taxa those searches found are fetched in
+        batches too (see taxids_to_infos). Threads sit idle (without holding
+        the GIL) while they wait on the network, so this scales well up to
+        the NCBI rate cap - which make_req still enforces across all of the
+        threads.
+        """
+        def search(org_name):
+            taxid_list = self.organism_to_id(org_name, verbose=verbose)
+            return org_name, self.single_taxid(org_name, taxid_list)
+
+        canonical, pending = self._pending_names(names)
+        try:
+            unresolved = []
+            for batch in batches(pending):
+                unresolved += self.resolve_batch(
+                    batch, self.names_to_infos(batch))
+            # The session only keeps MAX_CONNECTIONS connections open - any
+            # more threads than that and urllib3 would be opening (and
+            # throwing away) a new connection for every extra request
+            workers = min(workers, MAX_CONNECTIONS)
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                found = [(org_name, taxid) for org_name, taxid
+                         in executor.map(search, unresolved) if taxid]
+
+            missing = list(dict.fromkeys(
+                taxid for _, taxid in found
+                if self.lookup_taxid(taxid) is None))
+            for batch in batches(missing):
+                for taxon_info in self.taxids_to_infos(batch):
+                    self.remember_taxid(taxon_info.taxon_id, taxon_info)
+            for org_name, taxid in found:
+                taxon_info = self.lookup_taxid(taxid)
+                if taxon_info is None:
+                    # i.e. a taxon that has been merged into another one comes
+                    # back under its new id
+                    taxon_info = self.taxid_to_info(taxid)
+                    self.remember_taxid(taxid, taxon_info)
+                self.remember(org_name, taxon_info)
+        finally:
+            # keep whatever we managed to look up, even if something failed
+            self.commit()
+        return self._results(canonical)
 
-        taxon_info = self.organism_to_dict(org_name)
-        self.organisms_known[org_name] = taxon_info
+    def match_frame(
+        self,
+        names: list,
+        verbose: bool = False,
+        progress: bool = False):
+        """ Input:
+                names: list - the names of the organisms we want to match
+                verbose: bool - if True, some information will be printed as
+                    the data is retrieved.
+                progress: bool - if True, a progress bar is shown (if tqdm is
+                    installed)
+            Output:
+                pd.DataFrame - one row per name, with columns:
+                    - name: the name as it was given
+                    - rank, sci_name, taxon_id: for the organism itself
+                    - <rank>_sci_name, <rank>_taxon_id: for each of the
+                        return_ranks
+                    Names that couldn't be matched get a row of NaNs.
+
+        The names are looked up one at a time - see organisms_to_frame for
+        doing it in batches.
+        """
+        names = list(names)
+        taxa = (self.match(name, verbose)
+                for name in (progress_bar(names) if progress else names))
+        return self.taxa_to_frame(names, taxa)
+
+    def organisms_to_frame(
+        self,
+        organisms: list,
+        workers: int = 3,
+        verbose: bool = False):
+        """ Input:
+                organisms: list - the names of the organisms we want to match
+                workers: int - passed along to match_many_threaded
+                verbose: bool - if True, some information will be printed as
+                    the data is retrieved.
+            Output:
+                pd.DataFrame - the same as match_frame
+
+        A version of match_frame for long lists of names: they're looked up
+        with match_many_threaded (mostly in batches of BATCH_SIZE), and then
+        the frame is built in one go.
+        """
+        organisms = list(organisms)
+        results = self.match_many_threaded(organisms, workers, verbose)
+        return self.taxa_to_frame(
+            organisms,
+            (results[organism] for organism in organisms))
+
+    def taxa_to_frame(
+        self,
+        names: list,
+        taxa):
+        """ Input:
+                names: list - the names of the organisms
+                taxa: Iterable - the TaxonInfo (or False) for each of the names
+            Output:
+                pd.DataFrame - see match_frame
+
+        The columns are built up as lists and handed to pandas all at once,
+        rather than building a dict (or frame) per organism and stitching them
+        together.
+        """
+        # imported here, like in preprocess_names
+        import pandas as pd
+        rank_index = self._rank_index
+        n_ranks = len(self.return_ranks)
+        ranks, sci_names, taxon_ids = [], [], []
+        rank_sci_names = [[] for _ in range(n_ranks)]
+        rank_taxon_ids = [[] for _ in range(n_ranks)]
+        for taxon_info in taxa:
+            row_sci_names = [None] * n_ranks
+            row_taxon_ids = [None] * n_ranks
+            if taxon_info:
+                ranks.append(taxon_info.rank)
+                sci_names.append(taxon_info.sci_name)
+                taxon_ids.append(taxon_info.taxon_id)
+                organism = TaxonEntry(
+                    taxon_info.rank, taxon_info.sci_name, taxon_info.taxon_id)
+                for entry in taxon_info.lineage + (organism,):
+                    i = rank_index.get(entry.rank)
+                    if i is not None:
+                        row_sci_names[i] = entry.sci_name
+                        row_taxon_ids[i] = entry.taxon_id
+            else:
+                ranks.append(None)
+                sci_names.append(None)
+                taxon_ids.append(None)
+            for i in range(n_ranks):
+                rank_sci_names[i].append(row_sci_names[i])
+                rank_taxon_ids[i].append(row_taxon_ids[i])
+
+        columns = {
+            'name': names,
+            # there are only a handful of distinct ranks
+            'rank': pd.Categorical(ranks),
+            'sci_name': sci_names,
+            'taxon_id': pd.array(taxon_ids, dtype=TAXON_ID_DTYPE)}
+        for i, rank in enumerate(self.return_ranks):
+            columns[f'{rank}_sci_name'] = rank_sci_names[i]
+            columns[f'{rank}_taxon_id'] = pd.array(
+                rank_taxon_ids[i], dtype=TAXON_ID_DTYPE)
+        return pd.DataFrame(columns)
+
+    def lookup_known(
+        self,
+        org_name: str):
+        """ Input:
+                org_name: str - the name of the organism (after preprocessing)
+            Output:
+                The TaxonInfo we already have for the organism, False if we
+                already know it can't be matched, or None if we haven't looked
+                it up yet.
+        """
+        with self._state_lock:
+            if org_name in self.organisms_known:
+                return self.organisms_known[org_name]
+            if org_name in self.no_match or org_name in self.disambiguate:
+                return False
+            if self.cache is not None:
+                taxon_info = self.cache.get(org_name)
+                if taxon_info is not None:
+                    self.organisms_known[org_name] = taxon_info
+                    return taxon_info
+            return None
+
+    def remember(
+        self,
+        org_name: str,
+        taxon_info):
+        """ Input:
+                org_name: str - the name of the organism (after preprocessing)
+                taxon_info: TaxonInfo - the result of looking it up (or False)
+
+        Only actual matches are kept here - names that couldn't be matched
+        have already been added to no_match/disambiguate. They're looked up
+        again on the next run (after all, they might be the ones you've fixed
+        in the meantime) - unless cache_failures is set, in which case their
+        searches are kept (see remember_search and clear_failures).
+        """
+        if not taxon_info:
+            return
+        with self._state_lock:
+            self.organisms_known[org_name] = taxon_info
+            if self.cache is not None:
+                self.cache[org_name] = taxon_info
+
+    def lookup_taxid(
+        self,
+        taxid: int):
+        """ Input:
+                taxid: int - an NCBI taxonomic id
+            Output:
+                The TaxonInfo we already have for the taxon, or None if we
+                haven't retrieved it yet.
+        """
+        with self._state_lock:
+            if taxid in self.taxa_known:
+                return self.taxa_known[taxid]
+            if self.taxid_cache is not None:
+                taxon_info = self.taxid_cache.get(taxid)
+                if taxon_info is not None:
+                    self.taxa_known[taxid] = taxon_info
+                    return taxon_info
+            return None
+
+    def remember_taxid(
+        self,
+        taxid: int,
+        taxon_info):
+        """ Input:
+                taxid: int - the taxonomic id we asked the API about
+                taxon_info: TaxonInfo - what it told us
+        """
+        with self._state_lock:
+            self.taxa_known[taxid] = taxon_info
+            if self.taxid_cache is not None:
+                self.taxid_cache[taxid] = taxon_info
+
+    def lookup_search(
+            self,
+            organism: str):
+        """ Input:
+                organism: str - a name we've searched for
+            Output:
+                list - the idlist esearch returned for it on a previous run,
+                    or None if it isn't in the cache.
+        """
+        if self.search_cache is None:
+            return None
+        with self._state_lock:
+            return self.search_cache.get(organism)
+
+    def remember_search(
+            self,
+            organism: str,
+            id_list: list):
+        """ Input:
+                organism: str - the name we searched for
+                id_list: list - the idlist esearch returned for it
+
+        Searches that didn't find exactly one taxon are only kept if
+        cache_failures is set - otherwise a name that's been fixed on NCBI's
+        end (or a synonym they've since added) would never be found.
+        """
+        if self.search_cache is None:
+            return
+        if len(id_list) != 1 and not self.cache_failures:
+            return
+        with self._state_lock:
+            self.search_cache[organism] = id_list
+
+    def clear_failures(self):
+        """ Forgets every name that couldn't be matched - in this run (i.e.
+        no_match and disambiguate) and the searches kept by cache_failures -
+        so that they're searched for again.
+        """
+        with self._state_lock:
+            self.no_match.clear()
+            self.disambiguate.clear()
+            if self.search_cache is not None:
+                # the successful searches go too, but their taxa are still in
+                # the organisms table, so they won't be searched for again
+                self.search_cache.clear()
+
+    async def _make_req_async(
+            self,
+            url: str,
+            payload: dict,
+            method: str = 'GET'):
+        """ Input:
+                url: str - the url we want to make the request to
+                payload: dict - contains the values we want to pass as parameters
+                    in the URL's query string (or in the body, for a POST)
+                method: str - 'GET' or 'POST'. The API wants a POST when we're
+                    sending a long list of names or ids.
+            Output:
+                bytes - the body of the response returned by the NCBI API
+
+        The async counterpart to make_req. Each request waits on the shared
+        rate_limiter, so several requests can be in flight at once while we
+        still stay under the NCBI rate cap.
+        Failed requests are retried up to max_attempts times, waiting twice as
+        long after each failure (see retry_delay). A 429 also drains the
+        rate_limiter, so that every other request backs off too.
+        Needs the session opened by __aenter__ - like all of the async
+        methods, this has to be used inside "async with NCBI() as ncbi:".
+        """
+        if self._session is None:
+            raise RuntimeError(
+                'The async methods need an open session - use them inside '
+                '"async with NCBI() as ncbi:"')
+        if method == 'POST':
+            kwargs = {'data': payload}
+        else:
+            kwargs = {'params': payload}
+        for i in range(self.max_attempts + 1):
+            try:
+                await self.rate_limiter.acquire()
+                async with self._session.request(
+                        method, url, **kwargs) as resp:
+                    resp.raise_for_status()
+                    return await resp.read()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                status = getattr(e, 'status', None)
+                if i == self.max_attempts or (
+                        status is not None and status not in RETRY_STATUSES):
+                    raise e
+                delay = retry_delay(i, getattr(e, 'headers', None))
+                # not the exception itself - for a GET its message is the
+                # full url, api_key and email included
+                logger.warning(
+                    'connection issue (%s). Waiting %s seconds and trying '
+                    'again...', status or type(e).__name__, delay)
+                if status == 429:
+                    # acquire() will do the waiting for us (and for everyone
+                    # else)
+                    self.rate_limiter.drain(delay)
+                else:
+                    await asyncio.sleep(delay)
+
+    async def esearch_batch(
+            self,
+            names: list):
+        """ Input:
+                names: list - the names of the organisms we want to search for
+            Output:
+                (webenv, query_key, count): the location of the combined
+                    results on the NCBI history server, and the number of ids
+                    that were found.
+
+        Searches for all of the names in one request (as "name1 OR name2 OR
+        ..."). The results are left on the history server, so efetch_history
+        can retrieve them without us having to send the ids back.
+        """
+        content = await self._make_req_async(
+            ESEARCH_URL,
+            self.esearch_history_payload(names),
+            method='POST')
+        return parse_history(content)
+
+    async def _in_parser_pool(self, func: Callable, *args):
+        """ Input:
+                func: Callable - a parsing function
+                args - the arguments to call it with
+            Output:
+                whatever func returns
+
+        Runs func in one of the parser threads, so that the event loop isn't
+        blocked while a (possibly large) response is parsed.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._parser_pool, func, *args)
+
+    def parse_taxa(
+            self,
+            content: bytes):
+        """ Input:
+                content: bytes - an efetch response (for one or several taxa)
+            Output:
+                list - a TaxonInfo for each of the taxa
+        """
+        return list(self.iter_taxa(BytesIO(content)))
+
+    async def efetch_history(
+            self,
+            webenv: str,
+            query_key: str,
+            count: int):
+        """ Input:
+                webenv, query_key: str - as returned by esearch_batch
+                count: int - the number of taxa to retrieve
+            Output:
+                list - a TaxonInfo for each of the taxa
+        """
+        content = await self._make_req_async(
+            EFETCH_URL,
+            self.efetch_history_payload(webenv, query_key, count),
+            method='POST')
+        return await self._in_parser_pool(self.parse_taxa, content)
+
+    async def efetch_batch(
+            self,
+            taxids: list):
+        """ Input:
+                taxids: list - the taxon IDs that we want more information on
+            Output:
+                list - a TaxonInfo for each of the taxa
+
+        Retrieves all of the taxa in a single request (efetch accepts a comma
+        separated list of ids).
+        """
+        payload = self.efetch_payload(','.join(map(str, taxids)))
+        content = await self._make_req_async(
+            EFETCH_URL,
+            payload,
+            method='POST')
+        return await self._in_parser_pool(self.parse_taxa, content)
+
+    async def match_batch(
+            self,
+            names: list):
+        """ Input:
+                names: list - the names of the organisms we want to match (no
+                    more than BATCH_SIZE of them)
+            Output:
+                list - the names that couldn't be matched from the batched
+                    response, and need to be looked up one at a time.
+
+        Looks up a whole batch of names with one esearch and one efetch - see
+        resolve_batch for how the results are matched up with the names.
+        """
+        webenv, query_key, count = await self.esearch_batch(names)
+        if not count:
+            return list(names)
+        taxa = await self.efetch_history(webenv, query_key, count)
+        return self.resolve_batch(names, taxa)
+
+    def resolve_batch(
+            self,
+            names: list,
+            taxa: list):
+        """ Input:
+                names: list - the names of the organisms we searched for
+                taxa: list - the TaxonInfo for each taxon the search found
+            Output:
+                list - the names that couldn't be matched from the batched
+                    response, and need to be looked up one at a time.
+
+        Works out which taxon goes with which name by comparing the names to
+        the scientific names that came back, and remembers the ones that line
+        up. Anything that doesn't line up exactly (misspellings, synonyms,
+        names that match several taxa) is returned, so match can deal with it
+        the usual way - including adding it to disambiguate/no_match.
+
+        The combined search doesn't say which name found which taxon, so if
+        any taxon came back whose name isn't one we asked for (i.e. it was
+        found through a synonym), we can't rule out that it belongs to a name
+        that also had an exact match - match would put that name in
+        disambiguate. In that case none of the batch is resolved here; the
+        taxa are still remembered, so the individual lookups only cost an
+        esearch each.
+        The one case this can't catch is a name whose own search also finds
+        the taxon another name in the same batch matches exactly.
+        """
+        by_name = defaultdict(list)
+        for taxon_info in taxa:
+            self.remember_taxid(taxon_info.taxon_id, taxon_info)
+            by_name[normalize_name(taxon_info.sci_name)].append(taxon_info)
+
+        asked_for = {normalize_name(name) for name in names}
+        if not asked_for.issuperset(by_name):
+            return list(names)
+
+        unresolved = []
+        for name in names:
+            found = by_name.get(normalize_name(name), [])
+            if len(found) == 1:
+                self.remember(name, found[0])
+            else:
+                unresolved.append(name)
+        return unresolved
+
+    async def organism_to_id_async(
+            self,
+            organism: str,
+            verbose: bool = False):
+        """ Input:
+                organism: str - the name of the organism whose ID we want.
+                verbose: bool - if true, prints each organism name before
+                    starting the process
+            Output:
+                list - the idlist returned by the esearch endpoint
+        """
+        if verbose:
+            print('Starting organism:', organism)
+        id_list = self.lookup_search(organism)
+        if id_list is None:
+            content = await self._make_req_async(
+                ESEARCH_URL,
+                self.esearch_payload(organism))
+            id_list = parse_idlist(content)
+            self.remember_search(organism, id_list)
+        return id_list
+
+    async def organism_to_dict_async(
+            self,
+            organism: str,
+            verbose: bool = False):
+        ''' Input:
+                organism: str - the organism we're interested in
+                verbose: bool - if true, some progress info will be printed as
+                    the data is retrieved.
+            Output:
+                TaxonInfo - the taxonomy data about "organism" which was
+                    returned by the NCBI API, or False if there's no single
+                    match.
+        '''
+        taxid_list = await self.organism_to_id_async(organism, verbose)
+        taxid = self.single_taxid(organism, taxid_list)
+        if not taxid:
+            return False
+        taxon_info = self.lookup_taxid(taxid)
+        if taxon_info is None:
+            taxon_info = await self.taxid_to_info_async(taxid)
+            self.remember_taxid(taxid, taxon_info)
+        return taxon_info
+
+    async def taxid_to_info_async(
+            self,
+            taxid: int):
+        ''' The async version of taxid_to_info - same input and output.
+        '''
+        content = await self._make_req_async(
+            EFETCH_URL,
+            self.efetch_payload(taxid))
+        return await self._in_parser_pool(
+            self.single_taxon, BytesIO(content), taxid)
+
+    async def organism_to_dict_many(
+            self,
+            organisms: list,
+            verbose: bool = False):
+        ''' Input:
+                organisms: list - the organisms we're interested in (these
+                    aren't preprocessed or checked against what we already
+                    know - see match_many for that)
+                verbose: bool - if true, some progress info will be printed as
+                    the data is retrieved.
+            Output:
+                list - the result of organism_to_dict_async for each organism,
+                    in the same order.
+
+        Runs all of the lookups at once - the limiter in _make_req_async keeps
+        us under the rate cap, and the session's connector caps the number of
+        open connections.
+        '''
+        return await asyncio.gather(
+            *[self.organism_to_dict_async(o, verbose) for o in organisms])
+
+    async def match_async(
+        self,
+        org_name: str,
+        verbose: bool = False):
+        """ The async version of match - same inputs and output.
+        """
+        org_name = self.preprocessor(org_name)
+        taxon_info = self.lookup_known(org_name)
+        if taxon_info is not None:
+            return taxon_info
+
+        taxon_info = await self.organism_to_dict_async(org_name, verbose)
+        self.remember(org_name, taxon_info)
         return taxon_info
 
+    async def match_many(
+        self,
+        names: list,
+        concurrency: int = 3,
+        verbose: bool = False):
+        """ Input:
+                names: list - the names of the organisms we want to match
+                concurrency: int - the maximum number of lookups in flight at
+                    once
+                verbose: bool - if True, some information will be printed as
+                    the data is retrieved.
+            Output:
+                dict - maps each name to its TaxonInfo (or False, if a match
+                    couldn't be made)
+
+        Names we haven't seen before are first looked up in batches of
+        BATCH_SIZE (two requests per batch, see match_batch); whatever can't be
+        resolved that way is looked up individually and concurrently rather
+        than one after another. Since we're mostly waiting on the network, this
+        is much faster for long lists. i.e.:
+            async with NCBI() as ncbi:
+                results = await ncbi.match_many(names)
+        (in a notebook you can await this directly in a cell)
+        """
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def bounded_match(org_name):
+            async with semaphore:
+                taxon_info = await self.organism_to_dict_async(
+                    org_name, verbose)
+                self.remember(org_name, taxon_info)
+
+        canonical, pending = self._pending_names(names)
+        try:
+            unresolved = []
+            for batch in batches(pending):
+                unresolved += await self.match_batch(batch)
+            await asyncio.gather(*[bounded_match(n) for n in unresolved])
+        finally:
+            # keep whatever we managed to look up, even if something failed
+            self.commit()
+        return self._results(canonical)
+
+    async def run_pipeline(
+        self,
+        names: list,
+        search_workers: int = PIPELINE_SEARCH_WORKERS,
+        fetch_workers: int = PIPELINE_FETCH_WORKERS,
+        verbose: bool = False):
+        """ Input:
+                names: list - the names of the organisms we want to match
+                search_workers: int - the number of tasks running esearch
+                fetch_workers: int - the number of tasks running efetch
+                verbose: bool - if True, some information will be printed as
+                    the data is retrieved.
+            Output:
+                dict - maps each name to its TaxonInfo (or False, if a match
+                    couldn't be made)
+
+        Another way of matching a long list of names, set up as a pipeline of
+        queues:
+            - search tasks take names and run esearch on them, passing the
+                taxon ids they find on to the fetch tasks
+            - fetch tasks take up to BATCH_SIZE taxon ids at a time, retrieve
+                them with a single efetch, and pass the parsed taxa on
+            - a single writer task records the results (so only one task is
+                ever writing to organisms_known and the organism/taxa caches
+                - the search tasks only record their raw esearch results)
+        This way the searches don't have to wait on the (slower, bigger)
+        fetches, and vice versa. Unlike match_many, each name is searched for
+        on its own, so names that only match via a synonym are batched too.
+        """
+        canonical, pending = self._pending_names(names)
+        name_q = asyncio.Queue()
+        for org_name in pending:
+            name_q.put_nowait(org_name)
+        taxid_q = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+        result_q = asyncio.Queue()
+
+        async def search():
+            while not name_q.empty():
+                org_name = name_q.get_nowait()
+                taxid_list = await self.organism_to_id_async(org_name, verbose)
+                taxid = self.single_taxid(org_name, taxid_list)
+                if not taxid:
+                    continue
+                taxon_info = self.lookup_taxid(taxid)
+                if taxon_info is None:
+                    await taxid_q.put((org_name, taxid))
+                else:
+                    await result_q.put((org_name, taxid, taxon_info))
+
+        async def fetch():
+            item = True
+            while item is not None:
+                # wait for one, then take whatever else is already waiting (up
+                # to this worker's None, which means there's nothing left)
+                batch = []
+                item = await taxid_q.get()
+                while item is not None:
+                    batch.append(item)
+                    if len(batch) == BATCH_SIZE or taxid_q.empty():
+                        break
+                    item = taxid_q.get_nowait()
+                if not batch:
+                    continue
+                taxa = await self.efetch_batch(
+                    list({taxid for _, taxid in batch}))
+                by_taxid = {taxon_info.taxon_id: taxon_info
+                            for taxon_info in taxa}
+                for org_name, taxid in batch:
+                    taxon_info = by_taxid.get(taxid)
+                    if taxon_info is None:
+                        # i.e. a taxon that has been merged into another one
+                        # comes back under its new id
+                        taxon_info = await self.taxid_to_info_async(taxid)
+                    await result_q.put((org_name, taxid, taxon_info))
+
+        async def write():
+            while (result := await result_q.get()) is not None:
+                org_name, taxid, taxon_info = result
+                self.remember_taxid(taxid, taxon_info)
+                self.remember(org_name, taxon_info)
+
+        async def close_when_done(workers, queue, n_consumers):
+            await asyncio.gather(*workers)
+            for _ in range(n_consumers):
+                await queue.put(None)
+
+        searchers = [asyncio.ensure_future(search())
+                     for _ in range(search_workers)]
+        fetchers = [asyncio.ensure_future(fetch())
+                    for _ in range(fetch_workers)]
+        tasks = searchers + fetchers + [
+            asyncio.ensure_future(write()),
+            asyncio.ensure_future(
+                close_when_done(searchers, taxid_q, fetch_workers)),
+            asyncio.ensure_future(close_when_done(fetchers, result_q, 1))]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            # if one of the stages failed, don't leave the others waiting
+            for task in tasks:
+                task.cancel()
+            self.commit()
+        return self._results(canonical)
+
     def fix(self,
         org_name: str,
         verbose: bool = False):